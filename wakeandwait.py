@@ -10,55 +10,168 @@ This command first broadcasts the wake on lan magic package to all MAC adresses
 """
 
 from datetime import timedelta
+import errno
 import logging
+import os
 import re
 import sys
-from argparse import ArgumentParser
-from collections.abc import Iterable, Mapping, Sequence
-from concurrent.futures import Future, wait
-from concurrent.futures.thread import ThreadPoolExecutor
+import tomllib
+from argparse import ArgumentParser, ArgumentTypeError
+from collections import deque
+from collections.abc import Callable, Iterable, Mapping, Sequence
+from functools import cache, partial
+from heapq import heappop, heappush
+from itertools import count, zip_longest
 from pathlib import Path
-from socket import create_connection
+from random import random
+from selectors import EVENT_READ, EVENT_WRITE, DefaultSelector
+from socket import (
+    AF_INET,
+    IPPROTO_TCP,
+    SO_BROADCAST,
+    SO_ERROR,
+    SOCK_DGRAM,
+    SOCK_STREAM,
+    SOL_SOCKET,
+    TCP_NODELAY,
+    getaddrinfo,
+    socket,
+    socketpair,
+)
+from threading import Thread
 from time import monotonic, sleep
-from typing import Literal, TypedDict, overload
+from typing import IO, TYPE_CHECKING, TypedDict, overload
 
 from rich.console import Console, Group
-from rich.live import Live
 from rich.logging import RichHandler
-from rich.spinner import SPINNERS  # noqa
-from rich.status import Status
-from tomlkit import dump, load
-from wakeonlan import send_magic_packet
+import tomli_w
 from xdg.BaseDirectory import load_config_paths, save_config_path
 from unittest.mock import Mock
 import shlex
+import shutil
 import subprocess
-from subprocess import CalledProcessError
+from subprocess import PIPE, CalledProcessError
+
+if TYPE_CHECKING:
+    from rich.table import Table
+
+try:
+    from socket import TCP_QUICKACK
+except ImportError:  # Linux only
+    TCP_QUICKACK = None
 
 logger = Mock()
 
 DEFAULT_PORT = 22
+WOL_BROADCAST = "255.255.255.255"
+WOL_PORT = 9
+RECV_SIZE = 4096
 APP_NAME = "wakeandwait"
-SPINNERS["ok"] = {"interval": 1000, "frames": ["✔"]}
-SPINNERS["pulsedot"] = {"interval": 200, "frames": "·•●•·"}
+PULSE_FRAMES = "·•●•·"
+PULSE_INTERVAL = 0.2
 
-console = Console()
 QUIET = True
 
+_MAC_RE = re.compile(r"([0-9a-fA-F]{2}[:-]?){5}[0-9a-fA-F]{2}")
+
 
 def is_mac(arg: str) -> bool:
-    return re.match(r"([0-9a-fA-F]{2}[:-]?){5}[0-9a-fA-F]{2}", arg) is not None
+    # 12 hex digits plus up to five separators
+    return 12 <= len(arg) <= 17 and _MAC_RE.fullmatch(arg) is not None
 
 
 def is_port(arg: str) -> int | None:
-    if arg.isdigit():
+    if len(arg) <= 5 and arg.isascii() and arg.isdigit():
         port = int(arg)
         if 0 < port <= 0xFFFF:
             return port
     return None
 
 
+def magic_packet(mac: str) -> bytes:
+    return b"\xff" * 6 + bytes.fromhex(mac.replace(":", "").replace("-", "")) * 16
+
+
+def send_magic_packets(
+    macs: Sequence[str],
+    broadcasts: Sequence[str] = (WOL_BROADCAST,),
+    repeat: int = 1,
+    interval: float = 0.1,
+) -> None:
+    """Send every MAC's magic packet to every broadcast address, repeat times."""
+    packets = [magic_packet(mac) for mac in macs]
+    with socket(AF_INET, SOCK_DGRAM) as sock:
+        sock.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
+        for i in range(repeat):
+            if i:
+                sleep(interval)
+            for broadcast in broadcasts:
+                for packet in packets:
+                    sock.sendto(packet, (broadcast, WOL_PORT))
+
+
+def pulse() -> str:
+    """The current frame of the waiting spinner, shared by all services."""
+    frame = int(monotonic() / PULSE_INTERVAL)
+    return PULSE_FRAMES[frame % len(PULSE_FRAMES)]
+
+
+def indicator(done: bool, failed: bool = False) -> str:
+    if failed:
+        return "[red]✘[/red]"
+    return "[green]✔[/green]" if done else f"[green]{pulse()}[/green]"
+
+
+class Message:
+    """A line of the live display that is updated in place."""
+
+    text: str
+    done: bool = False
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+
+    def __rich__(self) -> str:
+        return f"{indicator(self.done)} {self.text}"
+
+
+def interleave_families(addresses: Sequence[tuple]) -> list[tuple]:
+    """Alternate the address families of getaddrinfo's results, keeping its order."""
+    by_family: dict[int, list[tuple]] = {}
+    for address in addresses:
+        by_family.setdefault(address[0], []).append(address)
+    return [
+        address
+        for addresses in zip_longest(*by_family.values())
+        for address in addresses
+        if address is not None
+    ]
+
+
+def make_table(services: Iterable["Service"]) -> "Table":
+    """A single grid with one row per service or command."""
+    from rich.table import Table
+
+    table = Table.grid(padding=(0, 1))
+    for service in services:
+        table.add_row(*service.row())
+    return table
+
+
 class Service:
+    # retry delays grow exponentially from backoff_base up to backoff_cap
+    # seconds, each stretched by a random factor of up to 1 + backoff_jitter
+    backoff_base: float = 1.0
+    backoff_cap: float = 10.0
+    backoff_jitter: float = 0.5
+    # give up on a connection attempt that is still pending after this long
+    connect_timeout: float = 2.0
+    # count a connected service that sends nothing this long as available
+    banner_timeout: float = 2.0
+    # start connecting to the next address when the current one has not
+    # connected after this long
+    happy_eyeballs_delay: float = 0.25
+
     host: str
     port: int
     ok: bool = False
@@ -67,15 +180,27 @@ class Service:
     start: float
     duration: float = 0
     tries: int = 0
-    status_widget: Status | None = None
-
-    def __init__(self, host: str, port: int, rich: bool = False) -> None:
+    delay: float
+    deadline: float | None = None
+    given_up: bool = False
+    perfdata: str
+    label: str
+    status: str = "[red]Connecting ...[/red]"
+    buffer: memoryview
+    addresses: list[tuple] | None = None
+    _connecting: bool = False
+    _racing: list[socket]
+    _next_address: int = 0
+    _error: Exception | None = None
+
+    def __init__(self, host: str, port: int) -> None:
         self.host = str(host)
         self.port = int(port)
         self.start = monotonic()
         self.tries = 0
-        if rich:
-            self.status_widget = Status(self, spinner="pulsedot")
+        self.delay = self.backoff_base
+        self.perfdata = f"0, {timedelta()}"
+        self.label = f"[bold]{self.host}[/bold]:{self.port:<5}"
 
     def update_status(
         self, ok: bool, /, msg: str | None = None, error: Exception | None = None
@@ -83,48 +208,204 @@ class Service:
         self.ok = ok
         self.answer = msg
         self.error = error
-        if self.status_widget and self.ok:
-            self.status_widget.update(self, spinner="ok", spinner_style="green")
-
-    def check1(self):
-        try:
-            logger.debug("Connecting to %s (%s:%s)", self, self.host, self.port)
-            self.tries = self.tries + 1
-            connection = create_connection((self.host, self.port))
-            logger.debug("Connected: Reading from %s", self)
-            answer_b = connection.recv(4096)
-            answer = answer_b.decode(encoding="utf-8", errors="replace")
-            self.duration = monotonic() - self.start
-            logger.info(
-                "%s is available (%s)",
-                self,
-                answer,
+        if ok:
+            answer = msg.strip().replace("\n", "|")
+            self.status = f"[green]{answer or 'Connected'}[/green]"
+        else:
+            self.status = f"[red]{error or 'Connecting ...'}[/red]"
+
+    def measure(self) -> None:
+        self.duration = monotonic() - self.start
+        # rendered on every refresh, so only format it when it changes
+        self.perfdata = f"{self.tries}, {timedelta(seconds=self.duration)}"
+
+    def attempt(self, poller: "Poller") -> None:
+        """Start non-blocking connection attempts that the poller completes."""
+        logger.debug("Connecting to %s (%s:%s)", self, self.host, self.port)
+        self.tries = self.tries + 1
+        if not self.addresses:
+            # Resolve only once, but keep trying until the name resolves. A
+            # lookup can block for the resolver's whole timeout, so it runs
+            # on a thread to keep the other targets going meanwhile.
+            poller.run_in_thread(
+                partial(getaddrinfo, self.host, self.port, type=SOCK_STREAM),
+                partial(self._resolved, poller, self.tries),
             )
-            self.update_status(True, msg=answer)
-        except OSError as e:
-            self.duration = monotonic() - self.start
-            logger.info(
-                "%s is not yet available (%s)",
-                self,
-                e,
-                exc_info=logger.isEnabledFor(logging.DEBUG),
+            return
+        self._race(poller)
+
+    def _resolved(
+        self,
+        poller: "Poller",
+        tries: int,
+        addresses: list[tuple] | None,
+        error: Exception | None,
+    ) -> None:
+        if tries != self.tries or self.given_up:
+            return
+        if error is not None:
+            self.failed(poller, error)
+            return
+        self.addresses = interleave_families(addresses)
+        self._race(poller)
+
+    def _race(self, poller: "Poller") -> None:
+        self._connecting = True
+        self._racing = []
+        self._next_address = 0
+        self._connect_next(poller, self.tries)
+        if self._connecting:
+            poller.call_later(
+                self.connect_timeout,
+                partial(self._connect_timeout, poller, self.tries),
             )
-            self.update_status(False, error=e)
-        return self.ok
 
-    def wait(self):
-        logger.debug("Waiting for %s", self)
-        try:
-            while not self.check1():
-                sleep(1)
-            return self
-        except Exception as e:
-            logger.error("Service %s failed: %s", self, e, exc_info=True)
-            raise
+    def _connect_next(self, poller: "Poller", tries: int) -> None:
+        """
+        Start connecting to the next address, racing those already started.
+
+        This is happy eyeballs (RFC 8305): the next address, usually of the
+        other family, gets its turn when the previous one failed or has not
+        connected within happy_eyeballs_delay.
+        """
+        if tries != self.tries or not self._connecting:
+            return
+        while self._next_address < len(self.addresses):
+            family, type_, proto, _, address = self.addresses[self._next_address]
+            self._next_address += 1
+            sock = None
+            try:
+                sock = socket(family, type_, proto)
+                sock.setblocking(False)
+                sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+                if TCP_QUICKACK is not None:
+                    sock.setsockopt(IPPROTO_TCP, TCP_QUICKACK, 1)
+                error = sock.connect_ex(address)
+                if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    raise OSError(error, os.strerror(error))
+            except OSError as e:
+                if sock is not None:
+                    sock.close()
+                self._error = e
+                continue
+            self._racing.append(sock)
+            if error == 0:
+                self._stop_racing(poller, sock)
+                poller.selector.register(sock, EVENT_READ, self._answered)
+                poller.call_later(
+                    self.banner_timeout, partial(self._banner_timeout, poller, sock)
+                )
+                return
+            # A banner that arrives together with the connection is read in
+            # the same wakeup, without another round through the selector.
+            poller.selector.register(sock, EVENT_READ | EVENT_WRITE, self._connected)
+            if self._next_address < len(self.addresses):
+                poller.call_later(
+                    self.happy_eyeballs_delay,
+                    partial(self._connect_next, poller, tries),
+                )
+            return
+        if not self._racing:
+            self._connecting = False
+            self.failed(poller, self._error)
+
+    def _stop_racing(self, poller: "Poller", winner: socket | None = None) -> None:
+        """Close all pending connection attempts except the winner's."""
+        self._connecting = False
+        for sock in self._racing:
+            if sock is not winner:
+                poller.selector.unregister(sock)
+                sock.close()
+        self._racing = []
+
+    def _connect_timeout(self, poller: "Poller", tries: int) -> None:
+        if tries != self.tries or not self._connecting:
+            return
+        self._stop_racing(poller)
+        self.failed(poller, TimeoutError("Connection timed out"))
+
+    def _connected(self, poller: "Poller", sock: socket, events: int) -> None:
+        error = sock.getsockopt(SOL_SOCKET, SO_ERROR)
+        if error:
+            poller.selector.unregister(sock)
+            sock.close()
+            self._racing.remove(sock)
+            self._error = OSError(error, os.strerror(error))
+            # don't wait for the delay to try the next address
+            self._connect_next(poller, self.tries)
+            return
+        logger.debug("Connected: Reading from %s", self)
+        self._stop_racing(poller, sock)
+        if events & EVENT_READ:
+            self._answered(poller, sock, events)
+        else:
+            poller.selector.modify(sock, EVENT_READ, self._answered)
+            poller.call_later(
+                self.banner_timeout, partial(self._banner_timeout, poller, sock)
+            )
 
-    @property
-    def perfdata(self) -> str:
-        return f"{self.tries}, {timedelta(seconds=self.duration)}"
+    def _answered(self, poller: "Poller", sock: socket, events: int) -> None:
+        poller.selector.unregister(sock)
+        try:
+            size = sock.recv_into(self.buffer)
+        except OSError as e:
+            self.failed(poller, e)
+            return
+        finally:
+            sock.close()
+        self._available(
+            poller, str(self.buffer[:size], encoding="utf-8", errors="replace")
+        )
+
+    def _banner_timeout(self, poller: "Poller", sock: socket) -> None:
+        try:
+            if poller.selector.get_key(sock).data != self._answered:
+                return
+        except (KeyError, ValueError):  # answered and closed meanwhile
+            return
+        # the handshake already showed that the service is up, it just waits
+        # for the client to speak first
+        poller.selector.unregister(sock)
+        sock.close()
+        self._available(poller, "")
+
+    def _available(self, poller: "Poller", answer: str) -> None:
+        self.measure()
+        logger.info(
+            "%s is available (%s)",
+            self,
+            answer,
+        )
+        self.update_status(True, msg=answer)
+        poller.finished(self)
+
+    def failed(self, poller: "Poller", error: Exception) -> None:
+        self.measure()
+        self.report_failure(error)
+        self.update_status(False, error=error)
+        poller.finished(self)
+        delay = self.delay * (1 + random() * self.backoff_jitter)
+        if self.deadline is not None and monotonic() + delay >= self.deadline:
+            return  # the poller gives up on it at the deadline
+        poller.call_later(delay, partial(poller.start, self))
+        self.delay = min(self.delay * 2, self.backoff_cap)
+
+    def abort(self, poller: "Poller") -> None:
+        """Close the sockets of the attempt in flight, if any."""
+        for key in list(poller.selector.get_map().values()):
+            if getattr(key.data, "__self__", None) is self:
+                poller.selector.unregister(key.fileobj)
+                key.fileobj.close()
+        self._connecting = False
+        self._racing = []
+
+    def report_failure(self, error: Exception) -> None:
+        logger.info(
+            "%s is not yet available (%s)",
+            self,
+            error,
+            exc_info=error if logger.isEnabledFor(logging.DEBUG) else None,
+        )
 
     def __str__(self) -> str:
         return f"{self.host}:{self.port} ({self.perfdata})"
@@ -132,54 +413,132 @@ class Service:
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}({self.host!r}, {self.port!r})"
 
-    def __rich__(self) -> str:
-        color = "green" if self.ok else "red"
-        return f"[bold]{self.host}[/bold]:{self.port:<5}\t[{color}]{self.answer.strip( ).replace('\n', '|') or "Connected" if self.ok else self.error or 'Connecting ...'} [/{color}] ({self.perfdata})"
+    def row(self) -> tuple[str, str, str, str]:
+        """The cells of this service's line in the live table."""
+        return (
+            indicator(self.ok, self.given_up),
+            self.label,
+            self.status,
+            f"({self.perfdata})",
+        )
 
 
 class Command(Service):
+    # how often to check for a command's exit where there is no pidfd_open()
+    exit_poll_interval: float = 0.1
 
     command: list[str]
+    executable: str | None
+    _process: subprocess.Popen | None = None
+    _output: dict[IO[bytes], list[bytes]]
 
-    def __init__(self, command: str, rich: bool = False) -> None:
-        super().__init__("", 0, rich=rich)
+    def __init__(self, command: str) -> None:
+        super().__init__("", 0)
         self.command = shlex.split(command)
-
-    def check1(self):
+        self.label = f"[bold]{self.cmd_str}[/bold]"
+        # An absolute executable (and close_fds=False, our own descriptors are
+        # not inheritable anyway) lets subprocess use posix_spawn().
+        self.executable = shutil.which(self.command[0]) if self.command else None
+
+    def attempt(self, poller: "Poller") -> None:
+        """Spawn the command; the poller collects its output without blocking."""
+        logger.debug("Running command %s", self)
+        self.tries = self.tries + 1
         try:
-            logger.debug("Running command %s", self)
-            self.tries = self.tries + 1
-            result = subprocess.run(
-                self.command, capture_output=True, check=True, text=True
-            )
-            self.answer = result.stdout
-            self.duration = monotonic() - self.start
-            logger.info(
-                "Command %s finished with %s",
-                self,
-                self.answer,
+            self._process = subprocess.Popen(
+                self.command,
+                executable=self.executable,
+                stdout=PIPE,
+                stderr=PIPE,
+                close_fds=False,
             )
-            self.update_status(True, msg=self.answer)
         except OSError as e:
-            self.duration = monotonic() - self.start
+            self.failed(poller, e)
+            return
+        self._output = {self._process.stdout: [], self._process.stderr: []}
+        for pipe in self._output:
+            poller.selector.register(pipe, EVENT_READ, self._read)
+
+    def _read(self, poller: "Poller", pipe: IO[bytes], events: int) -> None:
+        size = os.readv(pipe.fileno(), [self.buffer])
+        if size:
+            self._output[pipe].append(self.buffer[:size].tobytes())
+            return
+        poller.selector.unregister(pipe)
+        pipe.close()
+        if not all(pipe.closed for pipe in self._output):
+            return
+        self._reap(poller, self.tries)
+
+    def _reap(self, poller: "Poller", tries: int) -> None:
+        """Finish once the process has exited, without blocking the poller."""
+        if tries != self.tries or self.given_up:
+            return
+        returncode = self._process.poll()
+        if returncode is None:
+            # it closed its output, but is still running
+            if hasattr(os, "pidfd_open"):
+                pidfd = open(os.pidfd_open(self._process.pid), "rb", buffering=0)
+                poller.selector.register(pidfd, EVENT_READ, self._exited)
+            else:
+                poller.call_later(
+                    self.exit_poll_interval, partial(self._reap, poller, tries)
+                )
+            return
+        stdout, stderr = (
+            b"".join(chunks).decode(encoding="utf-8", errors="replace")
+            for chunks in self._output.values()
+        )
+        self.measure()
+        if returncode:
+            self.failed(
+                poller, CalledProcessError(returncode, self.command, stdout, stderr)
+            )
+            return
+        logger.info(
+            "Command %s finished with %s",
+            self,
+            stdout,
+        )
+        self.update_status(True, msg=stdout)
+        poller.finished(self)
+
+    def _exited(self, poller: "Poller", pidfd: IO[bytes], events: int) -> None:
+        poller.selector.unregister(pidfd)
+        pidfd.close()
+        self._reap(poller, self.tries)
+
+    def abort(self, poller: "Poller") -> None:
+        """Close the pipes of a running command, then kill and reap it."""
+        super().abort(poller)
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+
+    def report_failure(self, error: Exception) -> None:
+        if isinstance(error, CalledProcessError):
             logger.info(
-                "Command %s failed with %s",
+                "Command %s failed with %d (%s)",
                 self,
-                e,
-                exc_info=logger.isEnabledFor(logging.DEBUG),
+                error.returncode,
+                error.stderr or error.stdout,
+                exc_info=error if logger.isEnabledFor(logging.DEBUG) else None,
             )
-            self.update_status(False, error=e)
-        except CalledProcessError as e:
-            self.duration = monotonic() - self.start
+        else:
             logger.info(
-                "Command %s failed with %d (%s)",
+                "Command %s failed with %s",
                 self,
-                e.returncode,
-                e.stderr or e.stdout,
-                exc_info=logger.isEnabledFor(logging.DEBUG),
+                error,
+                exc_info=error if logger.isEnabledFor(logging.DEBUG) else None,
             )
-            self.update_status(False, error=e)
-        return self.ok
+
+    def update_status(
+        self, ok: bool, /, msg: str | None = None, error: Exception | None = None
+    ):
+        super().update_status(ok, msg=msg, error=error)
+        if ok:
+            answer = msg.strip().replace("\n", "|")[:80]
+            self.status = f"[green]{answer or 'Success'}[/green]"
 
     @property
     def cmd_str(self) -> str:
@@ -191,14 +550,159 @@ class Command(Service):
     def __repr__(self) -> str:
         return f"{self.__class__.__name__}({shlex.join(self.command)!r}))"
 
-    def __rich__(self) -> str:
+    def row(self) -> tuple[str, str, str, str]:
         if self.tries < 1:
-            status = "[dim gray]Waiting ...[/dim gray]"
-        elif self.ok:
-            status = f"[green]{self.answer.strip().replace('\n', '|')[:80] or 'Success'}[/green]"
-        else:
-            status = f"[red]{self.error or 'Connecting ...'}[/red]"
-        return f"[bold]{self.cmd_str}[/bold] \t{status}\t({self.perfdata})"
+            return (
+                indicator(False),
+                self.label,
+                "[dim gray]Waiting ...[/dim gray]",
+                f"({self.perfdata})",
+            )
+        return super().row()
+
+
+class Poller:
+    """
+    Waits for services and commands on a single thread.
+
+    Every attempt registers its non-blocking sockets or pipes with the selector
+    (epoll on Linux, kqueue on BSD). Retries and timeouts are callbacks kept in
+    a heap of due times. The selector sleeps until the next one is due, so
+    there is only one wakeup per batch of due timers. At most concurrency
+    attempts are in flight at a time, the others queue up until one finishes.
+    Only name lookups, which cannot be made non-blocking, run on threads.
+
+    With a timeout, each target is given up once it has not succeeded within
+    that many seconds of its first attempt; with fail_fast, the first target
+    given up ends the run.
+
+    All answers and command output are received into one contiguous buffer
+    that is allocated once per run, each target owning a fixed slice of it.
+    """
+
+    def __init__(
+        self,
+        concurrency: int | None = None,
+        timeout: float | None = None,
+        fail_fast: bool = False,
+    ) -> None:
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.fail_fast = fail_fast
+        self.running: set[Service] = set()
+        self.waiting: deque[Service] = deque()
+        self.selector = DefaultSelector()
+        # worker threads queue their results and wake up the selector
+        self._results: deque[Callable[[], None]] = deque()
+        self._wakeup, self._notify = socketpair()
+        self._wakeup.setblocking(False)
+        self._notify.setblocking(False)
+        self.selector.register(self._wakeup, EVENT_READ, self._woken)
+        self.timers: list[tuple[float, int, Callable[[], None]]] = []
+        self._order = count()
+
+    def call_later(self, delay: float, callback: Callable[[], None]) -> None:
+        heappush(self.timers, (monotonic() + delay, next(self._order), callback))
+
+    def run_in_thread(
+        self,
+        function: Callable[[], object],
+        callback: Callable[[object, Exception | None], None],
+    ) -> None:
+        """
+        Call a blocking function on a thread of its own.
+
+        The poller passes its result, or the exception it raised, to
+        callback(result, error) on its own thread. Threads are only created
+        for attempts in flight, so there are at most concurrency of them.
+        """
+
+        def work() -> None:
+            try:
+                outcome = partial(callback, function(), None)
+            except Exception as e:
+                outcome = partial(callback, None, e)
+            self._results.append(outcome)
+            try:
+                self._notify.send(b"\0")
+            except OSError:  # closed meanwhile, or already woken often enough
+                pass
+
+        Thread(target=work, daemon=True).start()
+
+    def _woken(self, poller: "Poller", sock: socket, events: int) -> None:
+        try:
+            sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            pass
+        while self._results:
+            self._results.popleft()()
+
+    def start(self, service: Service) -> None:
+        if service.given_up:  # a retry that was due after the deadline
+            return
+        if self.concurrency and len(self.running) >= self.concurrency:
+            self.waiting.append(service)
+            return
+        self.running.add(service)
+        if service.deadline is None and self.timeout is not None:
+            service.deadline = monotonic() + self.timeout
+            self.call_later(self.timeout, partial(self.expire, service))
+        service.attempt(self)
+
+    def finished(self, service: Service) -> None:
+        self.running.discard(service)
+        if self.waiting:
+            self.start(self.waiting.popleft())
+
+    def expire(self, service: Service) -> None:
+        """Give up on a service that has not succeeded by its deadline."""
+        if service.ok or service.given_up:
+            return
+        service.abort(self)
+        service.measure()
+        service.update_status(
+            False, error=TimeoutError(f"Gave up after {self.timeout:g} s")
+        )
+        logger.info("Giving up on %s", service)
+        service.given_up = True
+        if service in self.waiting:
+            self.waiting.remove(service)
+        if service in self.running:
+            self.finished(service)
+
+    def run(self, services: Sequence[Service]) -> None:
+        """Attempt all services until each one is either ok or given up."""
+        buffer = memoryview(bytearray(RECV_SIZE * len(services)))
+        for index, service in enumerate(services):
+            service.buffer = buffer[index * RECV_SIZE : (index + 1) * RECV_SIZE]
+        for service in services:
+            self.start(service)
+        while not all(service.ok or service.given_up for service in services):
+            if self.fail_fast and any(service.given_up for service in services):
+                return
+            timeout = None
+            if self.timers:
+                timeout = max(0, self.timers[0][0] - monotonic())
+            for key, events in self.selector.select(timeout):
+                # an earlier callback of this batch may have closed it, e.g.
+                # a happy eyeballs race lost in the same wakeup
+                if self.selector.get_map().get(key.fd) is not key:
+                    continue
+                key.data(self, key.fileobj, events)
+            now = monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, callback = heappop(self.timers)
+                callback()
+
+    def close(self) -> None:
+        """Abort all attempts still in flight, including running commands."""
+        for service in list(self.running):
+            service.abort(self)
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+        self._notify.close()
 
 
 class OneConfig(TypedDict):
@@ -207,27 +711,42 @@ class OneConfig(TypedDict):
     run: list[str]
 
 
+@cache
 def load_all_settings():
+    """
+    Merge all config.toml files, parsed only once per process.
+
+    The result is shared: main() keeps it up to date with what it saves.
+    """
     config = {}
     for dir in reversed(list(load_config_paths(APP_NAME))):
         config_path = Path(dir, "config.toml")
-        if config_path.exists():
-            logger.debug("Loading configuration from %s", config_path)
-            with config_path.open("r") as f:
-                config.update(load(f))
+        try:
+            with config_path.open("rb") as f:
+                logger.debug("Loading configuration from %s", config_path)
+                config.update(tomllib.load(f))
+        except FileNotFoundError:
+            pass
     logger.debug("Final configuration: %s", config)
     return config
 
 
 @overload
 def save_settings(
-    destinations: OneConfig, /, name: str
+    destinations: OneConfig,
+    /,
+    name: str,
+    settings: dict[str, OneConfig | str] | None = None,
 ) -> dict[str, OneConfig | str]: ...
 
 
 @overload
 def save_settings(
-    destinations: OneConfig | None = None, /, name: str | None = None, default: str = ""
+    destinations: OneConfig | None = None,
+    /,
+    name: str | None = None,
+    default: str = "",
+    settings: dict[str, OneConfig | str] | None = None,
 ) -> dict[str, OneConfig | str]: ...
 
 
@@ -236,12 +755,18 @@ def save_settings(
     /,
     name: str | None = None,
     default: str | None = None,
+    settings: dict[str, OneConfig | str] | None = None,
 ) -> dict[str, OneConfig | str]:
+    """
+    Update the user's config.toml and return its new contents.
+
+    Pass the result of a previous call as settings to skip re-reading the file.
+    """
     settings_file = Path(save_config_path(APP_NAME), "config.toml")
-    if settings_file.exists():
-        with settings_file.open("r", encoding="utf-8") as f:
-            settings = load(f)
-    else:
+    if settings is None and settings_file.exists():
+        with settings_file.open("rb") as f:
+            settings = tomllib.load(f)
+    elif settings is None:
         settings = {}
     if default:
         settings["default"] = default
@@ -249,8 +774,8 @@ def save_settings(
         name = default
     if destinations and name:
         settings[name] = destinations
-    with settings_file.open("w", encoding="utf-8") as f:
-        dump(settings, f)
+    with settings_file.open("wb") as f:
+        tomli_w.dump(settings, f)
     logger.info("Saved settings %s to %s", settings, settings_file)
     return settings
 
@@ -262,13 +787,20 @@ def parse_dests(dests: Sequence[str], config: dict[str, str | OneConfig]) -> One
     services = []
     commands = []
     args = list(reversed(dests))
+    # configuration entries already expanded, which also stops alias cycles
+    visited: set[str] = set()
     while args:
         arg = args.pop()
-        if arg in config:
-            value = config[arg]
+        value = config.get(arg)
+        if value is not None:
+            if arg in visited:
+                continue
+            visited.add(arg)
             if isinstance(value, Mapping):
                 macs.extend(value.get("wake", []))
-                services.extend(value.get("check", []))
+                # copies, so that the shared configuration is never modified
+                services.extend((host, port) for host, port in value.get("check", []))
+                commands.extend(value.get("run", []))
             elif value in config:
                 args.append(value)
             else:
@@ -277,23 +809,47 @@ def parse_dests(dests: Sequence[str], config: dict[str, str | OneConfig]) -> One
                     arg,
                     value,
                 )
-        elif is_mac(arg):
-            macs.append(arg)
-        elif is_port(arg):
-            port = int(arg)
+        # cheapest tests first: ports are at most 5 characters, MACs at least 12
+        elif arg[:1] == "!":
+            commands.append(arg[1:])
+        elif (arg_port := is_port(arg)) is not None:
+            port = arg_port
             if host is not None:
                 services.append((host, port))
-        elif arg.startswith("!"):
-            commands.append(arg[1:])
+        elif is_mac(arg):
+            macs.append(arg)
         else:
             old_host, host = host, arg
             if port is not None:
                 services.append((host, port))
             elif old_host is not None:
                 services.append((old_host, DEFAULT_PORT))
+    if host is not None and port is None:
+        services.append((host, DEFAULT_PORT))
     return OneConfig(wake=macs, check=services, run=commands)
 
 
+def non_negative_int(arg: str) -> int:
+    value = int(arg)
+    if value < 0:
+        raise ArgumentTypeError(f"{value} is negative")
+    return value
+
+
+def positive_int(arg: str) -> int:
+    value = int(arg)
+    if value < 1:
+        raise ArgumentTypeError(f"{value} is not positive")
+    return value
+
+
+def non_negative_float(arg: str) -> float:
+    value = float(arg)
+    if not value >= 0:  # also rejects nan
+        raise ArgumentTypeError(f"{arg} is not a non-negative number")
+    return value
+
+
 def parse_args(argv=None):
     parser = ArgumentParser(description=__doc__)
     # wol = parser.add_argument_group(title="Wake on LAN options")
@@ -325,6 +881,49 @@ def parse_args(argv=None):
         default=False,
         help="Desktop notification when everything is awake",
     )
+    parser.add_argument(
+        "--wol-repeat",
+        type=positive_int,
+        metavar="N",
+        default=5,
+        help="Send the WOL magic packet N times (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--wol-interval",
+        type=non_negative_float,
+        metavar="SECONDS",
+        default=0.1,
+        help="Pause between repeated WOL magic packets (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-b",
+        "--broadcast",
+        action="append",
+        metavar="ADDRESS",
+        help="Send the WOL magic packet to this broadcast address, may be "
+        f"repeated for several subnets (default: {WOL_BROADCAST})",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=non_negative_int,
+        metavar="N",
+        default=64,
+        help="Probe at most N services or commands at a time, 0 for no limit "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=non_negative_float,
+        metavar="SECONDS",
+        help="Give up on services or commands that did not succeed within SECONDS",
+    )
+    parser.add_argument(
+        "--fail-fast",
+        action="store_true",
+        default=False,
+        help="Stop waiting as soon as one service or command has been given up",
+    )
     parser.add_argument(
         "destinations",
         nargs="*",
@@ -336,115 +935,112 @@ def parse_args(argv=None):
     return parser.parse_args(argv)
 
 
+@cache
+def get_console() -> Console:
+    # created on first use, terminal detection is not free
+    return Console()
+
+
 def configure_logging(verbosity: int, quiet: bool):
     global QUIET, logger
-    QUIET = quiet and console.is_terminal
+    # no live display when asked to, or when the output is not a terminal
+    QUIET = quiet or not get_console().is_terminal
     level = logging.ERROR - (10 * verbosity)
     logging.basicConfig(
-        level=level, format="%(message)s", handlers=[RichHandler(console=console)]
+        level=level,
+        format="%(message)s",
+        handlers=[RichHandler(console=get_console())],
     )
     logger = logging.getLogger("__name__")
 
 
-def describe_future(
-    future: Future | Iterable[Future], method: Literal["str", "repr"] = "str"
-) -> str:
-    if not isinstance(future, Future):
-        return ", ".join(describe_future(f, method) for f in future)
-
-    if method == "str":
-        convert = str
-    else:
-        convert = repr
-    if future is None:
-        return "<no future>"
-    elif future.done():
-        try:
-            return convert(future.result())
-        except Exception as e:
-            return convert(e)
-    else:
-        return convert(future)
-
-
-def waitandwake(destinations: OneConfig):
+def waitandwake(
+    destinations: OneConfig,
+    wol_repeat: int = 5,
+    wol_interval: float = 0.1,
+    broadcasts: Sequence[str] = (WOL_BROADCAST,),
+    concurrency: int | None = 64,
+    timeout: float | None = None,
+    fail_fast: bool = False,
+):
     logger.info("Destinations: %s", destinations)
     wake_status = None
     macs = destinations.get("wake", [])
     service_specs = destinations.get("check", [])
     command_specs = destinations.get("run", [])
     live = None
+    poller = None
     try:
+        services = [Service(*spec) for spec in service_specs]
+        commands = [Command(spec) for spec in command_specs]
         if not QUIET:
-            wake_status = Status(
-                f"Sending WOL magic packet to {len(macs)} devices ...",
-                spinner="pulsedot",
+            from rich.live import Live
+
+            wake_status = Message(
+                f"Sending WOL magic packet to {len(macs)} devices ..."
             )
-            services = [Service(*spec, rich=True) for spec in service_specs]
-            commands = [Command(spec, rich=True) for spec in command_specs]
+            # one refresh thread rebuilds the table at the spinner's rate
             live = Live(
-                Group(
-                    wake_status,
-                    *(service.status_widget for service in services),
-                    *(command.status_widget for command in commands),
+                get_renderable=lambda: Group(
+                    wake_status, make_table([*services, *commands])
                 ),
-                console=console,
+                console=get_console(),
+                refresh_per_second=round(1 / PULSE_INTERVAL),
+                auto_refresh=True,
             )
             live.start()
-        else:
-            services = [Service(*spec) for spec in service_specs]
-            commands = [Command(spec) for spec in command_specs]
-            live = None
 
         # wake
         if macs:
-            send_magic_packet(*macs)
+            # some NICs only wake reliably when they see several packets
+            send_magic_packets(macs, broadcasts, wol_repeat, wol_interval)
             macs_str = ", ".join(macs)
-            logger.info("Sent WOL magic packet to %s", macs_str)
+            logger.info("Sent WOL magic packet %d times to %s", wol_repeat, macs_str)
             if wake_status is not None:
-                wake_status.update(
-                    f"Sent WOL magic packet to {macs_str}.", spinner="ok"
-                )
-                wake_status.stop()
+                wake_status.text = f"Sent WOL magic packet to {macs_str}."
+                wake_status.done = True
         else:
             logger.info("No MACs to wake up")
             if wake_status is not None:
-                wake_status.update("No MACs to wake up")
-                wake_status.stop()
+                wake_status.text = "No MACs to wake up"
+                wake_status.done = True
 
-        executor = ThreadPoolExecutor()
-
-        # def cancel(signal, trace):
-        #     logger.info("Shutting down ...")
-        #     executor.shutdown(True, cancel_futures=True)
-        #
-        # signal(SIGINT, cancel)
+        if services or commands:
+            poller = Poller(concurrency, timeout, fail_fast)
 
         # wait
         if services:
             logger.info("Starting services %s", services)
-            futures = [executor.submit(service.wait) for service in services]
-            done, failed = wait(futures)
+            try:
+                poller.run(services)
+            except Exception as e:
+                logger.error("Some services failed: %s", e, exc_info=True)
+                sys.exit(1)
+            failed = [service for service in services if not service.ok]
             if failed:
-                logger.error("Some services failed: %s", describe_future(failed))
+                logger.error("Some services failed: %s", failed)
                 sys.exit(1)
-            else:
-                logger.debug("All services are up: %s", describe_future(done))
+            logger.debug("All services are up: %s", services)
         else:
             logger.info("No services to wait for.")
 
         # run
         if commands:
             logger.info("Starting commands %s", commands)
-            futures = [executor.submit(command.wait) for command in commands]
-            done, failed = wait(futures)
+            try:
+                poller.run(commands)
+            except Exception as e:
+                logger.error("Some commands failed: %s", e, exc_info=True)
+                sys.exit(2)
+            failed = [command for command in commands if not command.ok]
             if failed:
                 logger.error("Some commands failed: %s", failed)
                 sys.exit(2)
-            else:
-                logger.debug("All commands have run successfully: %s", done)
+            logger.debug("All commands have run successfully: %s", commands)
 
     finally:
+        if poller is not None:
+            poller.close()
         if live is not None:
             live.stop()
     if services:
@@ -472,11 +1068,13 @@ def main():
     all_settings = load_all_settings()
     destinations = parse_dests(options.destinations, all_settings)
 
+    saved = None
     if options.save:
-        all_settings.update(save_settings(destinations, name=options.save))
+        saved = save_settings(destinations, name=options.save)
+        all_settings.update(saved)
     if options.default:
         if options.default in all_settings:
-            all_settings.update(save_settings(default=options.default))
+            all_settings.update(save_settings(default=options.default, settings=saved))
         elif options.save:
             logger.error("There is no setting %s: Not setting as default")
         elif destinations:
@@ -490,9 +1088,9 @@ def main():
                 "There is no setting %s, and no configuration passed: Not setting as default"
             )
     if not options.save or options.default:
-        if not destinations:
-            destinations = parse_dests("default", all_settings)
-            if destinations:
+        if not options.destinations:
+            destinations = parse_dests(["default"], all_settings)
+            if any(destinations.values()):
                 logger.info("No destinations on the command line, using default config")
             else:
                 logger.critical(
@@ -500,7 +1098,15 @@ def main():
                 )
                 sys.exit(2)
 
-    services = waitandwake(destinations)
+    services = waitandwake(
+        destinations,
+        wol_repeat=options.wol_repeat,
+        wol_interval=options.wol_interval,
+        broadcasts=options.broadcast or [WOL_BROADCAST],
+        concurrency=options.concurrency,
+        timeout=options.timeout,
+        fail_fast=options.fail_fast,
+    )
     if options.notify:
         notify(services or destinations)
 